@@ -5,3 +5,6 @@ INPUT_SHAPE = 10, 10
 NUM_OUTPUT = 4
 VIDEO_FRAMES = 4
 VIDEO_INPUT_SHAPE = INPUT_SHAPE[0], INPUT_SHAPE[1] * VIDEO_FRAMES
+
+TF_INTRA_OP_THREADS = 2
+TF_INTER_OP_THREADS = 2
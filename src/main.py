@@ -1,3 +1,17 @@
+# thread pools must be configured before numpy/tensorflow are imported
+import os
+from constants import TF_INTRA_OP_THREADS, TF_INTER_OP_THREADS
+
+os.environ.setdefault("OMP_NUM_THREADS", str(TF_INTRA_OP_THREADS))
+os.environ.setdefault("TF_NUM_INTEROP_THREADS", str(TF_INTER_OP_THREADS))
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact,1,0")
+
+import tensorflow as tf
+
+# many small forward passes, so keep the thread pools small
+tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+
 from agent import DefaultAgent
 from qlearn import QLearningAgent
 from simulator import SimulatorModel, Simulator
@@ -20,7 +34,7 @@ def main(user: bool, headless: bool, model: str | None, training: bool):
             alpha=0.01,
             alpha_decay=0.01,
             y=0.6,
-            epsilon=0.98,
+            epsilon=0.02,
             input_shape=VIDEO_INPUT_SHAPE,
             num_actions=NUM_OUTPUT,
             batch_size=64,
@@ -30,6 +44,7 @@ def main(user: bool, headless: bool, model: str | None, training: bool):
             training_model=training,
             model_path=model,
             train_each_step=False,
+            target_update_every=25,
             debug=False,
         ),
     }
@@ -1,11 +1,17 @@
 # tensorflow
+import tensorflow as tf
 from tensorflow.keras.layers import Dense, InputLayer, Conv2D, Flatten
 from tensorflow.keras.optimizers import Adam
 from tensorflow.keras import Sequential
+from tensorflow.keras.models import clone_model
 
 # standard library
 import os
+import queue
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # others
 from agent import Agent
@@ -15,45 +21,151 @@ import logging
 log = logging.getLogger(__name__)
 
 
-class Experience:
+class ReplayMemory:
+    """
+    - Serves as a ring buffer that has a max_size
+    - Experiences are stored as preallocated arrays (one per field)
+    - Board states only hold {-1, 0, 1}, so they are stored as int8
+    - Sampling is prioritized by TD error using a sum-tree over the slots
+    - The importance-sampling exponent stays fixed (it is not annealed toward 1)
+    - Safe to add to and sample from different threads
+    """
 
     def __init__(
-        self, current_state, current_action, resulting_reward, resulting_state
+        self,
+        max_size: int,
+        state_shape: tuple[int, ...],
+        priority_exponent: float = 0.6,
+        importance_exponent: float = 0.4,
+        min_priority: float = 1e-3,
     ):
+        self._max_size: int = max_size
+        self.states: np.ndarray = np.zeros((max_size, *state_shape), dtype=np.int8)
+        self.actions: np.ndarray = np.zeros(max_size, dtype=np.int32)
+        self.rewards: np.ndarray = np.zeros(max_size, dtype=np.float32)
+        self.next_states: np.ndarray = np.zeros((max_size, *state_shape), dtype=np.int8)
+        # total number of experiences written (the next slot is _head % max_size)
+        self._head: int = 0
+        self._size: int = 0
+        self._lock = threading.Lock()
+        # sum-tree: node i holds the sum of nodes 2i and 2i + 1,
+        # slot j of the memory is the leaf at max_size + j (node 0 is unused)
+        self._tree: np.ndarray = np.zeros(2 * max_size, dtype=np.float64)
+        self._priority_exponent: float = priority_exponent
+        self._importance_exponent: float = importance_exponent
+        self._min_priority: float = min_priority
+        self._max_priority: float = 1.0
+
+    def __len__(self):
+        return self._size
+
+    def add_experience(self, current_state, current_action, reward, next_state):
         """
-        Holds the memory for replay
+        - Overwrites the oldest experience once the memory is full
+        - New experiences get the highest priority seen so far
         :param current_state: the current state of the model
         :param current_action: the action that was chosen
-        :param res_reward: the resulting reward
-        :param res_state: the resulting state
+        :param reward: the resulting reward
+        :param next_state: the resulting state
+        :return: None
         """
-        self.current_state: np.ndarray = current_state
-        self.current_action: int = current_action
-        self.res_reward: int = resulting_reward
-        self.next_state: np.ndarray = resulting_state
+        with self._lock:
+            i = self._head % self._max_size
+            self.states[i] = current_state
+            self.actions[i] = current_action
+            self.rewards[i] = reward
+            self.next_states[i] = next_state
+            self._set_priorities(np.array([i]), self._max_priority)
+            self._head += 1
+            self._size = min(self._size + 1, self._max_size)
 
+    def sample(self, num_samples):
+        """
+        - Draw random experiences proportionally to their priority
+        - Always returns num_samples experiences (a fixed batch shape)
+        :param num_samples: the number of experiences to draw
+        :return: (states, actions, rewards, next_states, indices, weights, head),
+            weights being the normalized importance-sampling weights and head the
+            write count at sampling time (pass it back to update_priorities())
+        """
+        with self._lock:
+            total = self._tree[1]
+            # one uniform draw per equal segment of the total priority
+            targets = (np.arange(num_samples) + np.random.rand(num_samples)) * (
+                total / num_samples
+            )
+            # walk each draw from the root down to a leaf
+            nodes = np.ones(num_samples, dtype=np.int64)
+            inner = nodes < self._max_size
+            while inner.any():
+                left = 2 * nodes[inner]
+                left_sum = self._tree[left]
+                go_right = targets[inner] > left_sum
+                targets[inner] -= go_right * left_sum
+                nodes[inner] = left + go_right
+                inner = nodes < self._max_size
+            # rounding can walk past the last filled slot
+            idx = np.minimum(nodes - self._max_size, self._size - 1)
+            probabilities = self._tree[idx + self._max_size] / total
+            weights = (self._size * probabilities) ** -self._importance_exponent
+            return (
+                self.states[idx].astype(np.float32),
+                self.actions[idx],
+                self.rewards[idx],
+                self.next_states[idx].astype(np.float32),
+                idx,
+                (weights / weights.max()).astype(np.float32),
+                self._head,
+            )
 
-class ReplayMemory:
-    """
-    - Serves as a queue that has a max_size
-    - Max size is by default None and should be added by the user
-    """
+    def update_priorities(self, indices, td_errors, head):
+        """
+        - Set the priority of sampled experiences from their new TD errors
+        - Slots overwritten by new experiences since sampling are skipped
+        :param indices: the indices returned by sample()
+        :param td_errors: the TD error of each sampled experience
+        :param head: the write count returned by sample()
+        :return: None
+        """
+        priorities = (np.abs(td_errors) + self._min_priority) ** self._priority_exponent
+        with self._lock:
+            writes = self._head - head
+            if writes >= self._max_size:
+                return
+            # the slots written since sampling follow on from head % max_size
+            kept = (indices - head) % self._max_size >= writes
+            if not kept.any():
+                return
+            priorities = priorities[kept]
+            self._set_priorities(indices[kept], priorities)
+            self._max_priority = max(self._max_priority, float(priorities.max()))
 
-    def __init__(self, max_size: int | None = None):
-        self._max_size: int | None = max_size
-        self._arr: list[Experience] = []
-        self._size: int = 0
+    def _set_priorities(self, indices, priorities):
+        """
+        - Write leaf priorities and recompute the sums of their ancestors
+        - Must be called while holding the lock
+        """
+        nodes = indices + self._max_size
+        self._tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[-1] >= 1:
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
 
-    def add_experience(self, ex: Experience):
-        if self._size == self._max_size and self._max_size is not None:
-            self._arr.pop(0)
-            self._size -= 1
-        self._arr.append(ex)
-        self._size += 1
 
-    def get_random_experiences(self, num_samples):
-        np.random.shuffle(self._arr)
-        return self._arr[0 : num_samples if num_samples < self._size else self._size]
+def build_targets(rewards, q_next, q_values, actions, gamma):
+    """
+    - Set the q_value of each chosen action to its Bellman target
+    - No other q_values are impacted (so they produce no error when training)
+    :param rewards: the resulting reward of each experience
+    :param q_next: predicted q_values of each resulting state
+    :param q_values: predicted q_values of each current state (updated in place)
+    :param actions: the action chosen in each experience
+    :param gamma: the discount factor
+    :return: q_values
+    """
+    q_values[np.arange(len(actions)), actions] = rewards + gamma * q_next.max(axis=1)
+    return q_values
 
 
 class QLearningParams:
@@ -89,6 +201,8 @@ class QLearningAgent(Agent):
         train_each_step: bool = False,
         debug: bool = False,
         timeout: bool = True,
+        max_checkpoints: int = 5,
+        target_update_every: int = 1000,
     ):
         # initialize Agent parent class
         # add one to num_inputs for current speed
@@ -102,40 +216,81 @@ class QLearningAgent(Agent):
         self.epsilon = epsilon
         self.batch_size = batch_size
         # Q learning replay memory
-        self.replay_memory = ReplayMemory(max_size=replay_mem_max)
+        self.replay_memory = ReplayMemory(
+            max_size=replay_mem_max, state_shape=(*input_shape, 1)
+        )
         # private state
         self._last_reward_time = time.time()
+        self._input_buf = np.empty((1, *input_shape, 1), dtype=np.float32)
         self._current_state = None
         self._current_action = None
         self._rewarded_currently = False
         self._collision_count = 0
         # load/save/training properties
         self._save_after = save_after
+        self._max_checkpoints = max_checkpoints
+        self._checkpoints: deque[str] = deque()
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._pending_save = None
         self._load_latest_model = load_latest_model
         self._training_model = training_model  # boolean
         self._model_path = model_path
         self._train_each_step = train_each_step
+        self._target_update_every = target_update_every
+        self._target_sync_pending = False
         self._timeout = timeout
         self._steps_without_reward = 0
         # debug private attributes
         self._debug = debug
+        # _model_lock guards the online weights, _inference_lock the inference copy
+        self._model_lock = threading.Lock()
+        self._inference_lock = threading.Lock()
+        # training thread (started at the end of __init__)
+        self._train_queue = queue.Queue(maxsize=1)
+        self._train_thread = None
         # build Sequential tensorflow model
         self._model = Sequential()
-        self._model.add(InputLayer(input_shape=(*input_shape, 1)))
+        self._model.add(InputLayer(input_shape=(*input_shape, 1), dtype="float32"))
         self._model.add(Conv2D(32, (3, 3), activation="relu", padding="same"))
         self._model.add(Conv2D(64, (3, 3), activation="relu", padding="same"))
         self._model.add(Flatten())
         self._model.add(Dense(256, activation="relu"))
         self._model.add(Dense(self.num_outputs, activation="linear"))
         self._model.compile(
-            loss="mse", optimizer=Adam(learning_rate=self.alpha, decay=alpha_decay)
+            loss="mse",
+            optimizer=Adam(learning_rate=self.alpha, decay=alpha_decay),
+            jit_compile=True,
         )
+        # cached XLA graph for forward passes (avoids predict() overhead per call)
+        self._forward = self._build_forward(self._model)
+        # copy of the model that update() reads, so inference never waits on
+        # the training thread (synced after each training step)
+        self._inference_model = self._model
+        self._inference_forward = self._forward
+        # copy of the model that checkpoints are written from (see _write_checkpoint)
+        self._checkpoint_model = clone_model(self._model)
+        # frozen copy of the model used for the bootstrapped q_value targets
+        self._target_model = None
+        self._target_forward = None
+        if self._training_model:
+            self._inference_model = clone_model(self._model)
+            self._inference_forward = self._build_forward(self._inference_model)
+            self._target_model = clone_model(self._model)
+            self._target_forward = self._build_forward(self._target_model)
+            self._sync_inference_model()
+            self._sync_target_model()
+        # quantized TF-Lite interpreter (only used when not training)
+        self._interpreter = None
+        self._interpreter_input = None
+        self._interpreter_output = None
         if self._debug:
             self._model.summary()
         if self._model_path is not None:
             self.load_model(self._model_path)
         elif self._load_latest_model:
             self.init_default_model_weights()
+        if not self._training_model:
+            self._build_interpreter()
         # Q learning rewards
         self._qlearn_params = QLearningParams(
             wall_collision_value=-20,
@@ -143,6 +298,15 @@ class QLearningAgent(Agent):
             reward_collision_value=20,
             other_value=-2,
         )
+        # precomputed per-step constants
+        self._restart_threshold = input_shape[0] * input_shape[1]
+        self._reward_delta = self._qlearn_params.reward - self._qlearn_params.other
+        # background training (overlaps simulation steps with fitting the model)
+        if self._training_model:
+            self._train_thread = threading.Thread(
+                target=self._train_worker, daemon=True
+            )
+            self._train_thread.start()
 
     def update(
         self, inputs, reward_collision=False, wall_collision=False, keys_pressed=None
@@ -155,21 +319,42 @@ class QLearningAgent(Agent):
         :param keys_pressed: a map of pressed keys (ignore, n/a)
         :return direction: int [0 - num_outputs)
         """
-        inputs = np.expand_dims(inputs, axis=0)
-        # expand the dimensions of the input
+        # write into the persistent (1, H, W, 1) float32 input batch
+        self._input_buf[0] = inputs
+        inputs = self._input_buf
         assert (
             self._simulator is not None
         ), "Simulator must be set using .set_simulator()"
-        reward = self._get_reward(reward_collision, wall_collision)
+        params = self._qlearn_params
+        # pick the reward arithmetically (wall collisions take precedence)
+        reward = (
+            wall_collision * params.wall
+            + (reward_collision and not wall_collision) * params.reward
+            + (not wall_collision and not reward_collision) * params.other
+        )
         # Change internal states
         self._handle_collision(wall_collision)
-        reward, restart = self._handle_reward(reward, reward_collision)
+        restart = False
+        if reward_collision:
+            self._steps_without_reward = 0
+            if not self._rewarded_currently:
+                self._last_reward_time = time.time()
+            # if the snake is sitting on a reward, punish it with "other" value
+            reward -= self._rewarded_currently * self._reward_delta
+            self._rewarded_currently = True
+        else:
+            self._steps_without_reward += 1
+            self._rewarded_currently = False
+            restart = self._steps_without_reward >= self._restart_threshold
+            reward += restart * params.wall
         self._handle_experience(reward, inputs)
         self._handle_training()
-        actions = self._model.predict(inputs, verbose=0)
+        with self._inference_lock:
+            actions = self._predict(inputs)
         action = np.argmax(actions)
-        if np.random.rand() > self.epsilon and self._training_model:
-            action = np.random.choice(np.arange(self.num_outputs))
+        # epsilon-greedy: explore with probability epsilon
+        if self._training_model and np.random.rand() < self.epsilon:
+            action = np.random.randint(self.num_outputs)
         self._current_action = action
         log.debug(
             f"Current Action: {action}, Current Reward: {reward}, Choices: {actions}"
@@ -178,100 +363,215 @@ class QLearningAgent(Agent):
             self._request_restart()
         return action
 
-    def _get_reward(self, reward_collision, wall_collision):
-        if wall_collision:
-            return self._qlearn_params.wall
-        elif reward_collision:
-            return self._qlearn_params.reward
-        else:
-            return self._qlearn_params.other
+    def _build_forward(self, model):
+        """
+        - Wrap a model's forward pass in a cached XLA graph
+        - The fixed input signature means it is traced exactly once
+        :param model: the model to wrap
+        :return: tf.function mapping a batch of inputs to q_values
+        """
+        return tf.function(
+            lambda x: model(x, training=False),
+            input_signature=[tf.TensorSpec((None, *self.input_shape, 1), tf.float32)],
+            jit_compile=True,
+        )
+
+    def _predict(self, inputs) -> np.ndarray:
+        """
+        - Run a forward pass of the inference model (used by update())
+        :param inputs: batch of game board inputs
+        :return: q_values for each input in the batch
+        """
+        if self._interpreter is not None:
+            self._interpreter.set_tensor(self._interpreter_input, inputs)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._interpreter_output)
+        return self._inference_forward(tf.constant(inputs, dtype=tf.float32)).numpy()
+
+    def _predict_online(self, inputs) -> np.ndarray:
+        """
+        - Run a forward pass of the model being trained
+        - Only the training thread changes its weights, so no lock is needed there
+        :param inputs: batch of game board inputs
+        :return: q_values for each input in the batch
+        """
+        return self._forward(tf.constant(inputs, dtype=tf.float32)).numpy()
+
+    def _predict_target(self, inputs) -> np.ndarray:
+        """
+        - Run a forward pass of the target model
+        :param inputs: batch of game board inputs
+        :return: q_values for each input in the batch
+        """
+        return self._target_forward(tf.constant(inputs, dtype=tf.float32)).numpy()
+
+    def _sync_inference_model(self, weights=None):
+        """
+        - Copy the current model weights into the inference model
+        :param weights: a snapshot of the model weights (taken if not given)
+        :return: None
+        """
+        if self._inference_model is not self._model:
+            if weights is None:
+                weights = self._model.get_weights()
+            with self._inference_lock:
+                self._inference_model.set_weights(weights)
+
+    def _sync_target_model(self, weights=None):
+        """
+        - Copy the current model weights into the target model
+        :param weights: a snapshot of the model weights (taken if not given)
+        :return: None
+        """
+        if self._target_model is not None:
+            if weights is None:
+                weights = self._model.get_weights()
+            self._target_model.set_weights(weights)
+
+    def _build_interpreter(self):
+        """
+        - Convert the model to an int8 (dynamic range) quantized TF-Lite model
+        - The converter also folds Conv+BN pairs and constant subgraphs
+        - Used for inference only, the Keras model is still used for training
+        :return: None
+        """
+        converter = tf.lite.TFLiteConverter.from_keras_model(self._model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        self._interpreter = tf.lite.Interpreter(model_content=converter.convert())
+        self._interpreter.allocate_tensors()
+        self._interpreter_input = self._interpreter.get_input_details()[0]["index"]
+        self._interpreter_output = self._interpreter.get_output_details()[0]["index"]
 
     def _handle_experience(self, reward, inputs):
         if self._current_state is not None:
             self.replay_memory.add_experience(
-                Experience(
-                    current_state=self._current_state,
-                    current_action=self._current_action,
-                    resulting_reward=reward,
-                    resulting_state=inputs,
-                )
+                current_state=self._current_state[0],
+                current_action=self._current_action,
+                reward=reward,
+                next_state=inputs[0],
             )
-        self._current_state = inputs
+        # inputs is the reused input buffer, so keep a copy of it
+        self._current_state = inputs.copy()
 
     def _handle_training(self):
         if self._training_model:
             if self._train_each_step:
-                self._train_model()
+                self._request_training()
 
     def _handle_collision(self, wall_collision):
         if wall_collision:
-            if self._collision_count % self._save_after == 0:
+            if (
+                self._save_after is not None
+                and self._collision_count % self._save_after == 0
+            ):
                 self._save_model_increment()
             if self._training_model:
-                self._train_model()
+                if self._collision_count % self._target_update_every == 0:
+                    # synced by the training thread before its next step
+                    self._target_sync_pending = True
+                self._request_training()
             self._collision_count += 1
 
-    def _handle_reward(self, reward, reward_collision):
-        restart = False
-        if reward_collision:
-            self._steps_without_reward = 0
-            if self._rewarded_currently:
-                # if the car is sitting on a reward, punish it with "other" value
-                reward -= self._qlearn_params.reward - self._qlearn_params.other
-            else:
-                self._last_reward_time = time.time()
-            self._rewarded_currently = True
-        else:
-            self._steps_without_reward += 1
-            self._rewarded_currently = False
-            if self._steps_without_reward >= (
-                self.input_shape[0] * self.input_shape[1]
-            ):
-                restart = True
-                reward += self._qlearn_params.wall
-
-        return reward, restart
-
     def _request_restart(self):
         if self._debug:
             log.debug("Requesting restart...")
         self._simulator.reset()
         self._steps_without_reward = 0
 
+    def _request_training(self):
+        """
+        - Signal the training thread to train on a new batch
+        - Dropped if a training step is already pending
+        :return: None
+        """
+        try:
+            self._train_queue.put_nowait(True)
+        except queue.Full:
+            pass
+
+    def _wait_for_training(self):
+        """
+        - Block until any pending training step has finished
+        :return: None
+        """
+        if self._train_thread is not None:
+            self._train_queue.join()
+
+    def _train_worker(self):
+        while True:
+            self._train_queue.get()
+            try:
+                self._train_model()
+            except Exception:
+                log.exception("Training step failed")
+            finally:
+                self._train_queue.task_done()
+
     def _train_model(self):
         """
         - Get [self.batch_size] number of experiences and train on those experiences
         """
-        batch = self.replay_memory.get_random_experiences(self.batch_size)
-        X_train = np.zeros((self.batch_size, *self.input_shape, 1))
-        y_train = np.zeros((self.batch_size, self.num_outputs))
-        for i, experience in enumerate(batch):
-            current_state = np.array(experience.current_state)
-            # predict the q_values
-            q_value_prediction = self._model.predict(current_state, verbose=0)
-            # set the target to be what the experience actually was
-            q_target = experience.res_reward
-            resulting_state = np.array(experience.next_state)
-            q_target = q_target + self.y * np.max(
-                self._model.predict(resulting_state, verbose=0)[0]
-            )
-            # adjust the weights (no other q_vals are impacted)
-            q_value_prediction[0][experience.current_action] = q_target
-            X_train[i] = current_state
-            y_train[i] = q_value_prediction[0]
+        if self._target_sync_pending:
+            self._target_sync_pending = False
+            self._sync_target_model()
+        # wait for a full batch so the XLA-compiled steps always see one shape
+        if len(self.replay_memory) < self.batch_size:
+            return
+        (
+            current_states,
+            actions,
+            rewards,
+            next_states,
+            indices,
+            weights,
+            head,
+        ) = self.replay_memory.sample(self.batch_size)
+        rows = np.arange(len(actions))
+        # predict the q_values
+        q_values = self._predict_online(current_states)
+        q_next = self._predict_target(next_states)
+        predicted = q_values[rows, actions]
+        q_values = build_targets(rewards, q_next, q_values, actions, self.y)
 
-        self._model.fit(
-            X_train, y_train, verbose=0, epochs=3, batch_size=self.batch_size
-        )
+        with self._model_lock:
+            # one gradient step per replay sample (skips fit()'s data adapter)
+            self._model.train_on_batch(current_states, q_values, sample_weight=weights)
+            snapshot = self._model.get_weights()
+        self._sync_inference_model(snapshot)
+        td_errors = q_values[rows, actions] - predicted
+        self.replay_memory.update_priorities(indices, td_errors, head)
 
     def _save_model_increment(self):
         """
         Save the current model to a unique location representing the current iteration
+        - Written on a background thread, only the latest checkpoints are kept
         :return: None
         """
-        self._model.save_weights(
-            "./src/assets/models/model_" + str(self._collision_count) + ".weights.h5"
-        )
+        path = "./src/assets/models/model_" + str(self._collision_count) + ".weights.h5"
+        self._pending_save = self._save_executor.submit(self._write_checkpoint, path)
+
+    def _write_checkpoint(self, path):
+        try:
+            # only hold the lock for the snapshot, not for the file write
+            with self._model_lock:
+                snapshot = self._model.get_weights()
+            self._checkpoint_model.set_weights(snapshot)
+            self._checkpoint_model.save_weights(path)
+            self._checkpoints.append(path)
+            while len(self._checkpoints) > self._max_checkpoints:
+                oldest = self._checkpoints.popleft()
+                if os.path.exists(oldest):
+                    os.remove(oldest)
+        except Exception:
+            log.exception(f"Saving checkpoint {path} failed")
+
+    def _wait_for_save(self):
+        """
+        - Block until any pending checkpoint has been written
+        :return: None
+        """
+        if self._pending_save is not None:
+            wait([self._pending_save])
 
     def save_model(self, path):
         """
@@ -279,12 +579,13 @@ class QLearningAgent(Agent):
         :param path: the path to the model
         :return: None
         """
-        self._model.save_weights(os.path.join("src", "assets", "models", path))
+        self._wait_for_training()
+        self._wait_for_save()
+        with self._model_lock:
+            self._model.save_weights(os.path.join("src", "assets", "models", path))
 
     def init_default_model_weights(self):
-        self._model.load_weights(
-            os.path.join("src", "assets", "models", "latest.weights.h5")
-        )
+        self._load_weights(os.path.join("src", "assets", "models", "latest.weights.h5"))
 
     def load_model(self, path: str):
         """
@@ -292,6 +593,28 @@ class QLearningAgent(Agent):
         :param path: the path to the model
         :return: None
         """
-        self._model.load_weights(
-            os.path.join("src", "assets", "models", path)
-        )
+        self._load_weights(os.path.join("src", "assets", "models", path))
+
+    def _load_weights(self, path):
+        """
+        - Load weights into the model and every copy of it
+        - Waits for any pending training step so it doesn't race the training thread
+        :param path: the full path to the weights file
+        :return: None
+        """
+        self._wait_for_training()
+        with self._model_lock:
+            self._model.load_weights(path)
+            snapshot = self._model.get_weights()
+        self._sync_inference_model(snapshot)
+        self._sync_target_model(snapshot)
+        self._refresh_interpreter()
+
+    def _refresh_interpreter(self):
+        """
+        - Rebuild the inference interpreter so it reflects newly loaded weights
+        - No-op until the interpreter has been built (see __init__)
+        :return: None
+        """
+        if self._interpreter is not None:
+            self._build_interpreter()
@@ -3,6 +3,7 @@ from gui.components import Board
 from utils import calculate_fps
 from snake import Snake
 from time import time
+from collections import deque
 import numpy as np
 import pygame
 import os
@@ -76,11 +77,10 @@ class InputFrame:
         """
         self.input_shape = input_shape
         self.m = m
-        self.inputs = []
+        self.inputs = deque(maxlen=m)
 
     def update(self, inputs):
-        if len(self.inputs) == self.m:
-            self.inputs.pop(0)
+        # the deque drops the oldest input once m inputs are held
         self.inputs.append(inputs)
 
     def get_input(self):